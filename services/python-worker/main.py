@@ -6,25 +6,41 @@ Consumes events from Kafka topics and processes them.
 Stores processed results in PostgreSQL database.
 """
 
-import json
+import asyncio
+import glob
 import logging
+import multiprocessing
 import os
+import random
+import shutil
 import signal
 import sys
+import tempfile
 import time
-from datetime import datetime
-from typing import Any, Dict
-
-import psycopg2
-from kafka import KafkaConsumer
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+import asyncpg
+import orjson
+from confluent_kafka import Consumer, KafkaError, KafkaException, TopicPartition
 from opentelemetry import trace
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ALWAYS_ON, ParentBased
 from opentelemetry.semconv.resource import ResourceAttributes
-from prometheus_client import Counter, Histogram, start_http_server
-from pythonjsonlogger import jsonlogger
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
 
 # Metrics
 messages_processed = Counter(
@@ -33,24 +49,115 @@ messages_processed = Counter(
 processing_duration = Histogram(
     "worker_processing_duration_seconds", "Message processing duration", ["topic"]
 )
+# Only observed with DEBUG_TIMING, as it costs two clock reads per message
+row_build_duration = Histogram(
+    "worker_row_build_duration_seconds",
+    "Time spent turning a message into a database row",
+    ["topic"],
+)
 db_operations = Counter(
     "worker_db_operations_total", "Total database operations", ["operation", "status"]
 )
 
+# Batching configuration
+BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", "500"))
+BATCH_FLUSH_INTERVAL_MS = int(os.getenv("WORKER_BATCH_FLUSH_INTERVAL_MS", "200"))
+# Batches at least this large are written with COPY instead of executemany
+COPY_THRESHOLD = int(os.getenv("WORKER_COPY_THRESHOLD", "100"))
+# Number of tasks draining the batch queue into the database
+WRITER_CONCURRENCY = int(os.getenv("WORKER_WRITER_CONCURRENCY", "4"))
+# Exponential backoff between database connection and write retries
+DB_RETRY_DELAY_SECONDS = float(os.getenv("WORKER_DB_RETRY_DELAY_SECONDS", "1"))
+DB_RETRY_MAX_DELAY_SECONDS = float(os.getenv("WORKER_DB_RETRY_MAX_DELAY_SECONDS", "10"))
+# Failures caused by the connection or a restarting or overloaded server rather
+# than by the rows; these clear on their own, so only they are retried
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.AdminShutdownError,
+    asyncpg.CrashShutdownError,
+)
+# Maximum number of messages returned by a single consume() call
+KAFKA_MAX_POLL_RECORDS = int(os.getenv("KAFKA_MAX_POLL_RECORDS", "500"))
+
+# Ids are generated client-side so rows can be written with COPY
+INSERT_SQL = """
+INSERT INTO processed_events (id, event_type, resource_id, task_id, action, payload, processed_at)
+VALUES ($1, $2, $3, $4, $5, $6, $7)
+"""
+COPY_COLUMNS = [
+    "id",
+    "event_type",
+    "resource_id",
+    "task_id",
+    "action",
+    "payload",
+    "processed_at",
+]
+
+# Number of worker processes; each joins the same consumer group and is
+# assigned its own share of the partitions
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))
+
+# Kafka headers a producer may set so the worker can skip decoding the payload;
+# together they are every field a task.completed row needs
+HEADER_FIELDS = frozenset(("task_id", "resource_id", "action"))
+
+# Share of messages traced with a process_message span
+TRACE_SAMPLE_RATIO = float(os.getenv("OTEL_TRACES_SAMPLER_ARG", "0.05"))
+
+# Run the event loop on uvloop (Linux/macOS only)
+USE_UVLOOP = os.getenv("USE_UVLOOP", "").lower() in ("1", "true", "yes")
+
+# Also observe how long each message takes to turn into a row
+DEBUG_TIMING = os.getenv("DEBUG_TIMING", "").lower() in ("1", "true", "yes")
+
+# Emit an INFO progress line every this many messages; 0 disables it
+LOG_SAMPLE_INTERVAL = int(os.getenv("LOG_SAMPLE_INTERVAL", "1000"))
+
 # Global variables
-db_conn = None
+db_pool = None
 running = True
+# Set by the supervisor to stop worker processes
+stop_event = None
+processed_count = 0
+# The Kafka consumer is not thread-safe, so every call goes through one thread
+kafka_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kafka")
+
+
+class FastJsonFormatter(logging.Formatter):
+    """Minimal JSON log formatter built on orjson
+
+    Context fields are passed as extra={"extra_fields": {...}} so records do
+    not have to be scanned for non-standard attributes.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": self.formatTime(record),
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+        }
+        extra_fields = getattr(record, "extra_fields", None)
+        if extra_fields:
+            entry.update(extra_fields)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
 
 # Setup structured logging
 logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter(
-    "%(asctime)s %(name)s %(levelname)s %(message)s",
-    rename_fields={"asctime": "timestamp", "levelname": "level"},
-)
+formatter = FastJsonFormatter()
 logHandler.setFormatter(formatter)
 logger = logging.getLogger(__name__)
 logger.addHandler(logHandler)
-logger.setLevel(logging.INFO)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
 
 def init_telemetry():
@@ -64,251 +171,760 @@ def init_telemetry():
         }
     )
 
-    provider = TracerProvider(resource=resource)
+    # Messages are sampled in process_message, so every span it starts is kept
+    provider = TracerProvider(resource=resource, sampler=ParentBased(ALWAYS_ON))
+    # Larger queue and shorter delay keep bursts from dropping or holding spans;
+    # the standard OTEL_BSP_* variables override these defaults
     processor = BatchSpanProcessor(
-        OTLPSpanExporter(endpoint=otel_endpoint, insecure=True)
+        OTLPSpanExporter(endpoint=otel_endpoint, insecure=True),
+        max_queue_size=int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "4096")),
+        schedule_delay_millis=int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "1000")),
+        max_export_batch_size=int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "256")),
+        export_timeout_millis=int(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "10000")),
     )
     provider.add_span_processor(processor)
     trace.set_tracer_provider(provider)
 
-    logger.info("OpenTelemetry initialized", extra={"endpoint": otel_endpoint})
+    logger.info(
+        "OpenTelemetry initialized",
+        extra={
+            "extra_fields": {
+                "endpoint": otel_endpoint,
+                "sample_ratio": TRACE_SAMPLE_RATIO,
+            }
+        },
+    )
     return trace.get_tracer(__name__)
 
 
-def init_database():
-    """Initialize PostgreSQL database connection"""
+async def init_connection(conn):
+    """Store JSONB payloads from the original message bytes without re-encoding"""
+    # The JSONB binary format is a version byte followed by the JSON text
+    await conn.set_type_codec(
+        "jsonb",
+        schema="pg_catalog",
+        encoder=lambda value: b"\x01" + value,
+        decoder=lambda value: orjson.loads(value[1:]),
+        format="binary",
+    )
+
+
+def shutting_down() -> bool:
+    """Whether a signal or the supervisor has asked the worker to stop"""
+    return not running or (stop_event is not None and stop_event.is_set())
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff delay for the given zero-based retry attempt"""
+    return min(DB_RETRY_DELAY_SECONDS * 2**attempt, DB_RETRY_MAX_DELAY_SECONDS)
+
+
+async def init_database():
+    """Initialize the shared PostgreSQL connection pool
+
+    Retries with backoff until the database is reachable; returns None if
+    shutdown is requested first. Errors that retrying cannot fix, such as bad
+    credentials or a missing database, exit the process.
+    """
     db_config = {
         "host": os.getenv("WORKER_DB_HOST", "localhost"),
-        "port": os.getenv("WORKER_DB_PORT", "5432"),
+        "port": int(os.getenv("WORKER_DB_PORT", "5432")),
         "user": os.getenv("WORKER_DB_USER", "postgres"),
         "password": os.getenv("WORKER_DB_PASSWORD", "postgres"),
         "database": os.getenv("WORKER_DB_NAME", "workerdb"),
     }
 
-    max_retries = 30
-    for attempt in range(max_retries):
+    attempt = 0
+    while not shutting_down():
         try:
-            conn = psycopg2.connect(**db_config)
-            conn.autocommit = False
-            logger.info("Database connection established", extra=db_config)
-            return conn
-        except psycopg2.OperationalError:
-            logger.info(f"Waiting for database... attempt {attempt + 1}/{max_retries}")
-            time.sleep(2)
+            pool = await asyncpg.create_pool(
+                **db_config,
+                min_size=int(os.getenv("WORKER_DB_POOL_MIN_SIZE", "4")),
+                max_size=int(os.getenv("WORKER_DB_POOL_MAX_SIZE", "16")),
+                statement_cache_size=1024,
+                init=init_connection,
+            )
+            logger.info(
+                "Database connection pool established",
+                extra={"extra_fields": db_config},
+            )
+            return pool
+        except CONNECTION_ERRORS as e:
+            delay = retry_delay(attempt)
+            logger.info(
+                f"Waiting for database... attempt {attempt + 1}",
+                extra={"extra_fields": {"error": str(e), "retry_in_seconds": delay}},
+            )
+            attempt += 1
+            await asyncio.sleep(delay)
+        except asyncpg.PostgresError as e:
+            logger.error(
+                "Failed to connect to database",
+                extra={
+                    "extra_fields": {
+                        "host": db_config["host"],
+                        "database": db_config["database"],
+                        "user": db_config["user"],
+                        "error": str(e),
+                    }
+                },
+            )
+            sys.exit(1)
 
-    logger.error("Failed to connect to database after maximum retries")
-    sys.exit(1)
+    return None
 
 
 def init_kafka_consumer():
-    """Initialize Kafka consumer"""
-    kafka_brokers = os.getenv("KAFKA_BROKERS", "localhost:9092").split(",")
-    consumer_group = os.getenv("KAFKA_CONSUMER_GROUP_WORKER", "python-worker-group")
+    """Initialize Kafka consumer
 
-    topics = [
-        "task.completed",
-        "resource.created",
-        "resource.updated",
-        "resource.deleted",
-    ]
+    The consumer subscribes in consume_loop, which owns the offsets that
+    must be dropped when partitions are revoked.
+    """
+    kafka_brokers = os.getenv("KAFKA_BROKERS", "localhost:9092")
+    consumer_group = os.getenv("KAFKA_CONSUMER_GROUP_WORKER", "python-worker-group")
 
-    consumer = KafkaConsumer(
-        *topics,
-        bootstrap_servers=kafka_brokers,
-        group_id=consumer_group,
-        auto_offset_reset="latest",
-        enable_auto_commit=True,
-        auto_commit_interval_ms=1000,
-        value_deserializer=lambda m: json.loads(m.decode("utf-8")),
-        key_deserializer=lambda m: m.decode("utf-8") if m else None,
+    topics = list(HANDLERS)
+
+    consumer = Consumer(
+        {
+            "bootstrap.servers": kafka_brokers,
+            "group.id": consumer_group,
+            "auto.offset.reset": "latest",
+            # Offsets are committed only after their rows are written
+            "enable.auto.commit": False,
+            # Larger fetches amortize broker round-trips on busy topics
+            "fetch.min.bytes": int(os.getenv("KAFKA_FETCH_MIN_BYTES", "65536")),
+            "fetch.wait.max.ms": int(os.getenv("KAFKA_FETCH_MAX_WAIT_MS", "200")),
+            "max.partition.fetch.bytes": int(
+                os.getenv("KAFKA_MAX_PARTITION_FETCH_BYTES", str(4 * 1024 * 1024))
+            ),
+            "fetch.max.bytes": int(
+                os.getenv("KAFKA_FETCH_MAX_BYTES", str(50 * 1024 * 1024))
+            ),
+            # Upper bound on librdkafka's local prefetch queue
+            "queued.max.messages.kbytes": int(
+                os.getenv("KAFKA_QUEUED_MAX_MESSAGES_KBYTES", "65536")
+            ),
+        }
     )
 
     logger.info(
         "Kafka consumer initialized",
-        extra={"brokers": kafka_brokers, "group_id": consumer_group, "topics": topics},
+        extra={
+            "extra_fields": {
+                "brokers": kafka_brokers,
+                "group_id": consumer_group,
+                "topics": topics,
+            }
+        },
     )
 
     return consumer
 
 
-def process_message(tracer, topic: str, key: str, value: Dict[Any, Any]) -> bool:
-    """Process a single Kafka message"""
+def process_message(
+    tracer,
+    topic: str,
+    key: str,
+    value: bytes,
+    headers: Optional[List[Tuple[str, bytes]]],
+    processed_at: datetime,
+) -> Optional[Tuple]:
+    """Process a single Kafka message into a processed_events row
+
+    Only a TRACE_SAMPLE_RATIO share of messages is traced; the rest skip span
+    creation altogether.
+    """
+    if random.random() >= TRACE_SAMPLE_RATIO:
+        return build_row(topic, key, value, headers, processed_at)
+
     with tracer.start_as_current_span("process_message") as span:
         span.set_attribute("topic", topic)
         span.set_attribute("key", key)
+        return build_row(topic, key, value, headers, processed_at)
 
-        start_time = time.time()
 
-        try:
-            logger.info(
+def build_row(
+    topic: str,
+    key: str,
+    value: bytes,
+    headers: Optional[List[Tuple[str, bytes]]],
+    processed_at: datetime,
+) -> Optional[Tuple]:
+    """Build the processed_events row for a message, recording its metrics"""
+    global processed_count
+
+    # Only subscribed topics have precomputed metric children
+    handler = HANDLERS.get(topic)
+    if handler is None:
+        logger.warning(f"Unknown topic: {topic}")
+        messages_processed.labels(topic=topic, status="failed").inc()
+        return None
+
+    start_ns = time.perf_counter_ns() if DEBUG_TIMING else 0
+
+    try:
+        # Per-message logs are DEBUG only; the payload itself is never logged
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(
                 "Processing message",
-                extra={"topic": topic, "key": key, "payload": value},
+                extra={
+                    "extra_fields": {
+                        "topic": topic,
+                        "key": key,
+                        "payload_size": len(value),
+                    }
+                },
             )
 
-            # Process based on topic
-            if topic == "task.completed":
-                result = process_task_completed(value)
-            elif topic.startswith("resource."):
-                result = process_resource_event(topic, value)
-            else:
-                logger.warning(f"Unknown topic: {topic}")
-                result = False
+        row = handler(header_fields(headers), value, processed_at)
 
-            duration = time.time() - start_time
-            processing_duration.labels(topic=topic).observe(duration)
+        if DEBUG_TIMING:
+            duration = (time.perf_counter_ns() - start_ns) / 1e9
+            ROW_BUILD_DURATION[topic].observe(duration)
 
-            status = "success" if result else "failed"
-            messages_processed.labels(topic=topic, status=status).inc()
+        # Buffered rows are counted as success by the writer once written
+        if row is not None:
+            status = "buffered"
+        else:
+            status = "failed"
+            MESSAGES_PROCESSED[(topic, status)].inc()
 
-            logger.info(
+        if debug:
+            logger.debug(
                 "Message processed",
-                extra={
-                    "topic": topic,
-                    "key": key,
-                    "status": status,
-                    "duration_seconds": duration,
-                },
+                extra={"extra_fields": {"topic": topic, "key": key, "status": status}},
             )
 
-            return result
+    except Exception as e:
+        logger.error(
+            "Error processing message",
+            extra={"extra_fields": {"topic": topic, "key": key, "error": str(e)}},
+            exc_info=True,
+        )
+        MESSAGES_PROCESSED[(topic, "error")].inc()
+        row = None
+
+    processed_count += 1
+    if LOG_SAMPLE_INTERVAL > 0 and processed_count % LOG_SAMPLE_INTERVAL == 0:
+        logger.info(
+            "Messages processed",
+            extra={
+                "extra_fields": {
+                    "processed_total": processed_count,
+                    "last_topic": topic,
+                }
+            },
+        )
+
+    return row
+
+
+def header_fields(headers: Optional[List[Tuple[str, bytes]]]) -> Dict[str, str]:
+    """Extract the known payload fields carried in Kafka headers"""
+    if not headers:
+        return {}
+    return {
+        key: value.decode("utf-8")
+        for key, value in headers
+        if key in HEADER_FIELDS and value
+    }
 
-        except Exception as e:
-            logger.error(
-                "Error processing message",
-                extra={"topic": topic, "key": key, "error": str(e)},
-                exc_info=True,
-            )
-            messages_processed.labels(topic=topic, status="error").inc()
-            return False
 
+def process_task_completed(
+    fields: Dict[str, str], raw: bytes, processed_at: datetime
+) -> Optional[Tuple]:
+    """Process task completed events
 
-def process_task_completed(payload: Dict[Any, Any]) -> bool:
-    """Process task completed events"""
+    The payload is only decoded when the headers do not carry every field.
+    """
+    payload = fields if fields.keys() >= HEADER_FIELDS else orjson.loads(raw)
     task_id = payload.get("task_id")
     resource_id = payload.get("resource_id")
     action = payload.get("action")
 
-    if not all([task_id, resource_id, action]):
-        logger.error("Missing required fields in task.completed payload", extra=payload)
-        return False
+    if not task_id or not resource_id or not action:
+        logger.error(
+            "Missing required fields in task.completed payload",
+            extra={"extra_fields": payload},
+        )
+        return None
+
+    # The VARCHAR columns reject non-string parameters such as numeric ids
+    return (
+        uuid.uuid4(),
+        "task.completed",
+        str(resource_id),
+        str(task_id),
+        str(action),
+        raw,
+        processed_at,
+    )
 
-    # Store in database
-    cursor = db_conn.cursor()
+
+def process_resource_event(
+    event_type: str,
+    action: str,
+    fields: Dict[str, str],
+    raw: bytes,
+    processed_at: datetime,
+) -> Optional[Tuple]:
+    """Process resource events (created, updated, deleted)
+
+    The payload is only decoded when the resource_id header is absent.
+    """
+    resource_id = fields.get("resource_id")
+
+    if not resource_id:
+        payload = orjson.loads(raw)
+        resource_id = payload.get("id")
+        if not resource_id:
+            logger.error(
+                "Missing resource ID in payload", extra={"extra_fields": payload}
+            )
+            return None
+
+    return (
+        uuid.uuid4(),
+        event_type,
+        str(resource_id),
+        None,
+        action,
+        raw,
+        processed_at,
+    )
+
+
+# Row builders keyed by topic, with each resource event's action bound up front
+HANDLERS = {
+    "task.completed": process_task_completed,
+    "resource.created": partial(process_resource_event, "resource.created", "created"),
+    "resource.updated": partial(process_resource_event, "resource.updated", "updated"),
+    "resource.deleted": partial(process_resource_event, "resource.deleted", "deleted"),
+}
+
+# Metric children resolved once per label combination instead of per message
+MESSAGES_PROCESSED = {
+    (topic, status): messages_processed.labels(topic=topic, status=status)
+    for topic in HANDLERS
+    for status in ("success", "failed", "error")
+}
+PROCESSING_DURATION = {
+    topic: processing_duration.labels(topic=topic) for topic in HANDLERS
+}
+ROW_BUILD_DURATION = {
+    topic: row_build_duration.labels(topic=topic) for topic in HANDLERS
+}
+DB_INSERT_SUCCESS = db_operations.labels(operation="insert", status="success")
+DB_INSERT_ERROR = db_operations.labels(operation="insert", status="error")
+
+
+async def write_rows(conn, rows):
+    """Write a batch of rows to the database in a single transaction"""
     try:
-        query = """
-        INSERT INTO processed_events (id, event_type, resource_id, task_id, action, payload, processed_at)
-        VALUES (gen_random_uuid(), %s, %s, %s, %s, %s, %s)
-        """
-        cursor.execute(
-            query,
-            (
-                "task.completed",
-                resource_id,
-                task_id,
-                action,
-                json.dumps(payload),
-                datetime.utcnow(),
-            ),
-        )
-        db_conn.commit()
-        db_operations.labels(operation="insert", status="success").inc()
-        return True
+        if len(rows) >= COPY_THRESHOLD:
+            await conn.copy_records_to_table(
+                "processed_events", records=rows, columns=COPY_COLUMNS
+            )
+        else:
+            await conn.executemany(INSERT_SQL, rows)
+        DB_INSERT_SUCCESS.inc(len(rows))
+        count_written(rows)
+    except CONNECTION_ERRORS:
+        raise
     except Exception as e:
-        db_conn.rollback()
-        db_operations.labels(operation="insert", status="error").inc()
-        logger.error(
-            "Database error processing task.completed", extra={"error": str(e)}
+        logger.warning(
+            "Batch insert failed, retrying rows individually",
+            extra={"extra_fields": {"rows": len(rows), "error": str(e)}},
         )
-        return False
-    finally:
-        cursor.close()
+        await insert_rows_individually(conn, rows)
 
 
-def process_resource_event(topic: str, payload: Dict[Any, Any]) -> bool:
-    """Process resource events (created, updated, deleted)"""
-    resource_id = payload.get("id")
+async def insert_rows_individually(conn, rows):
+    """Insert rows one at a time so a single bad record does not drop the batch
 
-    if not resource_id:
-        logger.error("Missing resource ID in payload", extra=payload)
-        return False
+    Each row commits on its own, so if the connection fails the rows already
+    settled are removed from rows before the error is raised; the writer then
+    retries only the rest.
+    """
+    for index, row in enumerate(rows):
+        try:
+            await conn.execute(INSERT_SQL, *row)
+            DB_INSERT_SUCCESS.inc()
+            MESSAGES_PROCESSED[(row[1], "success")].inc()
+        except CONNECTION_ERRORS:
+            del rows[:index]
+            raise
+        except asyncpg.UniqueViolationError:
+            # Ids are generated client-side, so a duplicate id means the row
+            # was stored by an earlier attempt whose reply was lost
+            DB_INSERT_SUCCESS.inc()
+            MESSAGES_PROCESSED[(row[1], "success")].inc()
+        except Exception as e:
+            DB_INSERT_ERROR.inc()
+            MESSAGES_PROCESSED[(row[1], "failed")].inc()
+            logger.error(
+                "Database error inserting processed event",
+                extra={
+                    "extra_fields": {
+                        "event_type": row[1],
+                        "resource_id": row[2],
+                        "error": str(e),
+                    }
+                },
+            )
 
-    event_type = topic
-    action = topic.split(".")[-1]  # Extract 'created', 'updated', or 'deleted'
 
-    cursor = db_conn.cursor()
+def count_written(rows):
+    """Count a written batch's messages as successfully processed, per topic"""
+    counts = {}
+    for row in rows:
+        counts[row[1]] = counts.get(row[1], 0) + 1
+    for event_type, count in counts.items():
+        MESSAGES_PROCESSED[(event_type, "success")].inc(count)
+
+
+def observe_batch_duration(rows, started_ns: int):
+    """Record the batch's fetch-to-write time averaged over its rows"""
+    elapsed = (time.perf_counter_ns() - started_ns) / 1e9
+    per_message = elapsed / len(rows)
+    for event_type in {row[1] for row in rows}:
+        PROCESSING_DURATION[event_type].observe(per_message)
+
+
+async def write_loop(queue: asyncio.Queue):
+    """Drain batches from the queue until a None sentinel is received"""
+    # Each writer holds one connection across batches instead of paying the
+    # pool's reset round-trip on every release; it is replaced only once closed
+    conn = None
     try:
-        query = """
-        INSERT INTO processed_events (id, event_type, resource_id, action, payload, processed_at)
-        VALUES (gen_random_uuid(), %s, %s, %s, %s, %s)
-        """
-        cursor.execute(
-            query,
-            (event_type, resource_id, action, json.dumps(payload), datetime.utcnow()),
+        while True:
+            batch = await queue.get()
+            try:
+                if batch is None:
+                    return
+                rows, written, started_ns = batch
+                # Rows not yet settled; a failed row-by-row fallback trims it
+                unwritten = list(rows)
+                # Retry connection failures until the batch lands; its offsets stay
+                # uncommitted meanwhile. Rows the database rejects are isolated
+                # by write_rows instead of blocking every later batch
+                attempt = 0
+                while True:
+                    try:
+                        if conn is None:
+                            conn = await db_pool.acquire()
+                        if unwritten:
+                            await write_rows(conn, unwritten)
+                            observe_batch_duration(rows, started_ns)
+                        written.set_result(None)
+                        break
+                    # write_rows only raises connection failures, but acquiring a
+                    # connection can fail with any server error; either way the
+                    # writer must keep going or its batch is never resolved
+                    except (*CONNECTION_ERRORS, asyncpg.PostgresError) as e:
+                        DB_INSERT_ERROR.inc()
+                        logger.error(
+                            "Error writing batch",
+                            extra={
+                                "extra_fields": {
+                                    "rows": len(unwritten),
+                                    "error": str(e),
+                                }
+                            },
+                            exc_info=True,
+                        )
+                        if conn is not None and conn.is_closed():
+                            await db_pool.release(conn)
+                            conn = None
+                        if shutting_down():
+                            break
+                        await asyncio.sleep(retry_delay(attempt))
+                        attempt += 1
+            finally:
+                queue.task_done()
+    finally:
+        if conn is not None:
+            await db_pool.release(conn)
+
+
+async def commit_offsets(consumer, in_flight: deque):
+    """Commit Kafka offsets for the leading batches whose rows are written"""
+    offsets = {}
+    while in_flight and in_flight[0][1].done():
+        offsets.update(in_flight.popleft()[0])
+
+    if not offsets:
+        return
+
+    def commit():
+        # A fetch queued ahead of this commit may have revoked partitions that
+        # another group member now owns; their offsets are no longer ours
+        assigned = {(tp.topic, tp.partition) for tp in consumer.assignment()}
+        partitions = [
+            TopicPartition(topic, partition, offset)
+            for (topic, partition), offset in offsets.items()
+            if (topic, partition) in assigned
+        ]
+        if partitions:
+            consumer.commit(offsets=partitions, asynchronous=False)
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(kafka_executor, commit)
+    except KafkaException as e:
+        logger.warning(
+            "Failed to commit Kafka offsets", extra={"extra_fields": {"error": str(e)}}
         )
-        db_conn.commit()
-        db_operations.labels(operation="insert", status="success").inc()
-        return True
-    except Exception as e:
-        db_conn.rollback()
-        db_operations.labels(operation="insert", status="error").inc()
-        logger.error(
-            "Database error processing resource event", extra={"error": str(e)}
+
+
+async def consume_loop(tracer, consumer, queue: asyncio.Queue, in_flight: deque):
+    """Fetch messages from Kafka and hand batches of rows to the writers"""
+    loop = asyncio.get_running_loop()
+    pending_rows = []
+    pending_offsets = {}
+    batch_started_ns = 0
+    last_flush = time.monotonic()
+
+    async def flush():
+        nonlocal pending_rows, pending_offsets
+        written = loop.create_future()
+        in_flight.append((pending_offsets, written))
+        await queue.put((pending_rows, written, batch_started_ns))
+        pending_rows, pending_offsets = [], {}
+
+    async def drop_revoked(partitions):
+        revoked = {(tp.topic, tp.partition) for tp in partitions}
+        for offsets, _ in in_flight:
+            for key in revoked.intersection(offsets):
+                del offsets[key]
+        for key in revoked.intersection(pending_offsets):
+            del pending_offsets[key]
+        logger.info(
+            "Kafka partitions revoked",
+            extra={
+                "extra_fields": {
+                    "partitions": [
+                        f"{topic}[{partition}]" for topic, partition in sorted(revoked)
+                    ]
+                }
+            },
+        )
+
+    def on_revoke(consumer, partitions):
+        # Called on the Kafka thread during consume(); wait until the offsets of
+        # revoked partitions are dropped so they are never committed over the
+        # new owner's progress. Their uncommitted messages are redelivered
+        asyncio.run_coroutine_threadsafe(drop_revoked(partitions), loop).result()
+
+    def fetch():
+        # Fetch messages, waking up in time to honour the flush interval
+        return loop.run_in_executor(
+            kafka_executor,
+            consumer.consume,
+            KAFKA_MAX_POLL_RECORDS,
+            BATCH_FLUSH_INTERVAL_MS / 1000,
         )
-        return False
+
+    await loop.run_in_executor(
+        kafka_executor, partial(consumer.subscribe, list(HANDLERS), on_revoke=on_revoke)
+    )
+
+    next_messages = fetch()
+    try:
+        while not shutting_down():
+            messages = await next_messages
+            # Start the next fetch right away so it overlaps with processing
+            next_messages = fetch()
+
+            # One timestamp per fetch; processed_at is a UTC TIMESTAMP column,
+            # which asyncpg expects as a naive datetime
+            processed_at = datetime.now(timezone.utc).replace(tzinfo=None)
+            if messages and not pending_offsets:
+                batch_started_ns = time.perf_counter_ns()
+
+            for message in messages:
+                error = message.error()
+                if error is not None:
+                    if error.code() != KafkaError._PARTITION_EOF:
+                        logger.error(
+                            "Kafka consume error",
+                            extra={"extra_fields": {"error": str(error)}},
+                        )
+                    continue
+
+                key = message.key()
+                row = process_message(
+                    tracer,
+                    message.topic(),
+                    key.decode("utf-8") if key else None,
+                    message.value(),
+                    message.headers(),
+                    processed_at,
+                )
+                if row is not None:
+                    pending_rows.append(row)
+                # The committed offset is the next message to read
+                pending_offsets[(message.topic(), message.partition())] = (
+                    message.offset() + 1
+                )
+
+            # Flush on batch size, or on elapsed time so quiet topics don't stall
+            elapsed_ms = (time.monotonic() - last_flush) * 1000
+            if len(pending_rows) >= BATCH_SIZE or elapsed_ms >= BATCH_FLUSH_INTERVAL_MS:
+                if pending_offsets:
+                    await flush()
+                last_flush = time.monotonic()
+
+            await commit_offsets(consumer, in_flight)
     finally:
-        cursor.close()
+        # Messages from a fetch still in flight are left uncommitted and will
+        # be redelivered; wait for it so the consumer thread is free again
+        await asyncio.wait([next_messages])
+        if pending_offsets:
+            await flush()
 
 
-def signal_handler(signum, frame):
+def signal_handler(signum):
     """Handle shutdown signals gracefully"""
     global running
     logger.info(f"Received signal {signum}, shutting down...")
     running = False
 
 
-def main():
-    """Main worker loop"""
-    global db_conn, running
+async def main(supervisor_event=None):
+    """Main worker loop
+
+    When started by the supervisor, shutdown is requested through
+    supervisor_event and metrics are served by the supervisor process instead.
+    """
+    global db_pool, running, stop_event
 
     logger.info("Starting Python Worker Service")
+    stop_event = supervisor_event
+
+    # Setup signal handlers
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, signal_handler, signum)
 
     # Initialize components
     tracer = init_telemetry()
-    db_conn = init_database()
+    db_pool = await init_database()
+    if db_pool is None:
+        logger.info("Python Worker Service stopped before database was ready")
+        return
     consumer = init_kafka_consumer()
 
     # Start Prometheus metrics server
-    metrics_port = int(os.getenv("METRICS_PORT", "9092"))
-    start_http_server(metrics_port)
-    logger.info(f"Metrics server started on port {metrics_port}")
-
-    # Setup signal handlers
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    if supervisor_event is None:
+        metrics_port = int(os.getenv("METRICS_PORT", "9092"))
+        start_http_server(metrics_port)
+        logger.info(f"Metrics server started on port {metrics_port}")
+
+    # Writers drain batches so Kafka fetches overlap with database writes
+    queue = asyncio.Queue(maxsize=WRITER_CONCURRENCY * 2)
+    writers = [
+        asyncio.create_task(write_loop(queue)) for _ in range(WRITER_CONCURRENCY)
+    ]
+    # Offsets and completion futures of batches handed to the writers, in order
+    in_flight = deque()
 
     # Main processing loop
     logger.info("Starting message processing loop")
     try:
-        while running:
-            # Poll for messages with timeout
-            messages = consumer.poll(timeout_ms=1000)
-
-            for topic_partition, records in messages.items():
-                for record in records:
-                    process_message(tracer, record.topic, record.key, record.value)
+        await consume_loop(tracer, consumer, queue, in_flight)
 
     except Exception as e:
         logger.error(
-            "Unexpected error in main loop", extra={"error": str(e)}, exc_info=True
+            "Unexpected error in main loop",
+            extra={"extra_fields": {"error": str(e)}},
+            exc_info=True,
         )
 
     finally:
         logger.info("Cleaning up resources")
-        consumer.close()
-        if db_conn:
-            db_conn.close()
+        running = False
+        for _ in writers:
+            await queue.put(None)
+        await asyncio.gather(*writers)
+        await commit_offsets(consumer, in_flight)
+        await loop.run_in_executor(kafka_executor, consumer.close)
+        kafka_executor.shutdown()
+        await db_pool.close()
         logger.info("Python Worker Service stopped")
 
 
+def run_worker(supervisor_event=None):
+    """Run a single worker on its own event loop"""
+    if USE_UVLOOP:
+        import uvloop
+
+        uvloop.run(main(supervisor_event))
+    else:
+        asyncio.run(main(supervisor_event))
+
+
+def run_supervisor():
+    """Run WORKER_CONCURRENCY worker processes and serve their combined metrics"""
+    # Workers write metrics to a shared directory that must be set before they
+    # import prometheus_client; stale files from a previous run are removed
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    created_dir = not metrics_dir
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+    else:
+        metrics_dir = tempfile.mkdtemp(prefix="python-worker-metrics-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
+
+    try:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        metrics_port = int(os.getenv("METRICS_PORT", "9092"))
+        start_http_server(metrics_port, registry=registry)
+        logger.info(f"Metrics server started on port {metrics_port}")
+
+        ctx = multiprocessing.get_context("spawn")
+        supervisor_event = ctx.Event()
+
+        def handle_signal(signum, frame):
+            logger.info(f"Received signal {signum}, stopping worker processes...")
+            supervisor_event.set()
+
+        signal.signal(signal.SIGINT, handle_signal)
+        signal.signal(signal.SIGTERM, handle_signal)
+
+        processes = [
+            ctx.Process(
+                target=run_worker, args=(supervisor_event,), name=f"python-worker-{i}"
+            )
+            for i in range(WORKER_CONCURRENCY)
+        ]
+        for process in processes:
+            process.start()
+        logger.info(
+            "Worker processes started",
+            extra={"extra_fields": {"pids": [process.pid for process in processes]}},
+        )
+
+        for process in processes:
+            process.join()
+            multiprocess.mark_process_dead(process.pid)
+
+        logger.info("All worker processes stopped")
+        if any(process.exitcode for process in processes):
+            sys.exit(1)
+
+    finally:
+        # A directory the supervisor created itself is removed with its metric files
+        if created_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
 if __name__ == "__main__":
-    main()
+    if WORKER_CONCURRENCY > 1:
+        run_supervisor()
+    else:
+        run_worker()
@@ -0,0 +1,590 @@
+"""Tests for the Python worker's message handling and offset commits"""
+
+import asyncio
+import logging
+import sys
+import uuid
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+
+import asyncpg
+import orjson
+import pytest
+
+import main
+
+PROCESSED_AT = datetime(2024, 1, 1, 12, 0, 0)
+
+
+class FakeConsumer:
+    """Records commits and reports a fixed partition assignment"""
+
+    def __init__(self, assigned):
+        self.assigned = assigned
+        self.commits = []
+
+    def assignment(self):
+        return [
+            main.TopicPartition(topic, partition) for topic, partition in self.assigned
+        ]
+
+    def commit(self, offsets, asynchronous):
+        self.commits.append({(tp.topic, tp.partition): tp.offset for tp in offsets})
+
+
+def done_future(loop):
+    future = loop.create_future()
+    future.set_result(None)
+    return future
+
+
+def test_commit_offsets_waits_for_earlier_batches():
+    consumer = FakeConsumer([("task.completed", 0)])
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        first = loop.create_future()
+        in_flight = deque(
+            [
+                ({("task.completed", 0): 11}, first),
+                ({("task.completed", 0): 21}, done_future(loop)),
+            ]
+        )
+
+        # The second batch is written first, but committing it would skip the first
+        await main.commit_offsets(consumer, in_flight)
+        assert consumer.commits == []
+        assert len(in_flight) == 2
+
+        first.set_result(None)
+        await main.commit_offsets(consumer, in_flight)
+        assert consumer.commits == [{("task.completed", 0): 21}]
+        assert not in_flight
+
+    asyncio.run(scenario())
+
+
+def test_commit_offsets_stops_at_first_unwritten_batch():
+    consumer = FakeConsumer([("task.completed", 0), ("resource.created", 1)])
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        pending = loop.create_future()
+        in_flight = deque(
+            [
+                ({("task.completed", 0): 5}, done_future(loop)),
+                ({("resource.created", 1): 8}, done_future(loop)),
+                ({("task.completed", 0): 9}, pending),
+            ]
+        )
+        await main.commit_offsets(consumer, in_flight)
+        assert consumer.commits == [
+            {("task.completed", 0): 5, ("resource.created", 1): 8}
+        ]
+        assert list(in_flight) == [({("task.completed", 0): 9}, pending)]
+
+    asyncio.run(scenario())
+
+
+def test_commit_offsets_without_written_batches_does_not_commit():
+    consumer = FakeConsumer([("task.completed", 0)])
+    asyncio.run(main.commit_offsets(consumer, deque()))
+    assert consumer.commits == []
+
+
+def test_commit_offsets_skips_unassigned_partitions():
+    consumer = FakeConsumer([("task.completed", 0)])
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        in_flight = deque(
+            [
+                (
+                    {("task.completed", 0): 3, ("task.completed", 1): 7},
+                    done_future(loop),
+                )
+            ]
+        )
+        await main.commit_offsets(consumer, in_flight)
+
+    asyncio.run(scenario())
+    assert consumer.commits == [{("task.completed", 0): 3}]
+
+
+class Message:
+    """A consumed Kafka message carrying a resource event"""
+
+    def __init__(self, topic, partition, offset, value=b'{"id": "r-1"}'):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._value = value
+
+    def error(self):
+        return None
+
+    def key(self):
+        return None
+
+    def value(self):
+        return self._value
+
+    def headers(self):
+        return None
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+
+class RebalancingConsumer(FakeConsumer):
+    """Replays scripted fetches, revoking partitions between them on request"""
+
+    def __init__(self, assigned, fetches):
+        super().__init__(assigned)
+        self.fetches = list(fetches)
+
+    def subscribe(self, topics, on_revoke):
+        self.on_revoke = on_revoke
+
+    def consume(self, num_messages, timeout):
+        if not self.fetches:
+            main.running = False
+            return []
+        fetch = self.fetches.pop(0)
+        if isinstance(fetch, set):
+            revoked = [main.TopicPartition(*key) for key in fetch]
+            self.on_revoke(self, revoked)
+            self.assigned = [tp for tp in self.assigned if tp not in fetch]
+            return []
+        return fetch
+
+
+def test_consume_loop_drops_offsets_of_revoked_partitions(monkeypatch):
+    monkeypatch.setattr(main, "running", True)
+    # Keep everything buffered until the loop stops
+    monkeypatch.setattr(main, "BATCH_SIZE", 1000)
+    monkeypatch.setattr(main, "BATCH_FLUSH_INTERVAL_MS", 60_000)
+    consumer = RebalancingConsumer(
+        [("resource.created", 0), ("resource.created", 1)],
+        [
+            [Message("resource.created", 0, 10), Message("resource.created", 1, 20)],
+            {("resource.created", 1)},
+        ],
+    )
+
+    async def scenario():
+        queue = asyncio.Queue()
+        in_flight = deque()
+        await main.consume_loop(
+            main.trace.get_tracer(__name__), consumer, queue, in_flight
+        )
+        return in_flight
+
+    in_flight = asyncio.run(scenario())
+
+    assert [offsets for offsets, _ in in_flight] == [{("resource.created", 0): 11}]
+
+
+def test_consume_loop_flushes_full_batches_with_their_offsets(monkeypatch):
+    monkeypatch.setattr(main, "running", True)
+    monkeypatch.setattr(main, "BATCH_SIZE", 2)
+    monkeypatch.setattr(main, "BATCH_FLUSH_INTERVAL_MS", 60_000)
+    consumer = RebalancingConsumer(
+        [("resource.created", 0), ("resource.created", 1)],
+        [
+            [Message("resource.created", 0, 0), Message("resource.created", 0, 1)],
+            # A message without an id writes no row but its offset still advances
+            [
+                Message("resource.created", 1, 5),
+                Message("resource.created", 1, 6, value=b"{}"),
+            ],
+        ],
+    )
+
+    async def scenario():
+        queue = asyncio.Queue()
+        in_flight = deque()
+        await main.consume_loop(
+            main.trace.get_tracer(__name__), consumer, queue, in_flight
+        )
+        batches = [queue.get_nowait() for _ in range(queue.qsize())]
+        return batches, in_flight
+
+    batches, in_flight = asyncio.run(scenario())
+
+    assert [len(rows) for rows, _, _ in batches] == [2, 1]
+    assert [offsets for offsets, _ in in_flight] == [
+        {("resource.created", 0): 2},
+        {("resource.created", 1): 7},
+    ]
+    # Each queued batch resolves the future tracked for its offsets
+    assert [written for _, written, _ in batches] == [
+        written for _, written in in_flight
+    ]
+
+
+class FakeConnection:
+    """Records written rows, failing batch writes with batch_error if it is set"""
+
+    def __init__(self, batch_error=None, bad_rows=()):
+        self.batch_error = batch_error
+        self.bad_rows = bad_rows
+        self.inserted = []
+
+    async def copy_records_to_table(self, table, records, columns):
+        await self.executemany(main.INSERT_SQL, records)
+
+    async def executemany(self, sql, rows):
+        if self.batch_error is not None:
+            raise self.batch_error
+        self.inserted.extend(rows)
+
+    def is_closed(self):
+        return False
+
+    async def execute(self, sql, *row):
+        if row in self.bad_rows:
+            raise TypeError("expected str, got int")
+        self.inserted.append(row)
+
+
+def make_rows(count):
+    return [
+        (uuid.uuid4(), "resource.created", str(i), None, "created", b"{}", PROCESSED_AT)
+        for i in range(count)
+    ]
+
+
+def test_write_rows_isolates_rows_the_database_rejects():
+    rows = make_rows(3)
+    conn = FakeConnection(TypeError("expected str, got int"), bad_rows=[rows[1]])
+
+    asyncio.run(main.write_rows(conn, rows))
+
+    assert conn.inserted == [rows[0], rows[2]]
+
+
+def test_write_rows_raises_connection_failures_for_retry():
+    conn = FakeConnection(ConnectionResetError("connection reset"))
+
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(main.write_rows(conn, make_rows(2)))
+    assert conn.inserted == []
+
+
+class FakePool:
+    """Raises the queued acquire errors in turn, then hands out conn"""
+
+    def __init__(self, conn, errors):
+        self.conn = conn
+        self.errors = list(errors)
+        self.acquires = 0
+
+    async def acquire(self):
+        self.acquires += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.conn
+
+    async def release(self, conn):
+        pass
+
+
+def run_writer(batches):
+    """Run one write_loop over the given batches and return their futures"""
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        futures = []
+        for rows in batches:
+            written = loop.create_future()
+            futures.append(written)
+            queue.put_nowait((rows, written, 0))
+        queue.put_nowait(None)
+        await asyncio.wait_for(main.write_loop(queue), timeout=5)
+        return futures
+
+    return asyncio.run(scenario())
+
+
+def test_write_loop_retries_until_the_database_accepts_connections(monkeypatch):
+    conn = FakeConnection()
+    pool = FakePool(
+        conn,
+        [
+            asyncpg.CannotConnectNowError("the database system is starting up"),
+            asyncpg.TooManyConnectionsError("too many clients already"),
+            ConnectionRefusedError("connection refused"),
+        ],
+    )
+    monkeypatch.setattr(main, "db_pool", pool)
+    monkeypatch.setattr(main, "retry_delay", lambda attempt: 0)
+    rows = make_rows(2)
+
+    (written,) = run_writer([rows])
+
+    assert pool.acquires == 4
+    assert written.done()
+    assert conn.inserted == rows
+
+
+def test_write_loop_stops_retrying_on_shutdown(monkeypatch):
+    class ShutdownPool(FakePool):
+        async def acquire(self):
+            main.running = False
+            return await super().acquire()
+
+    pool = ShutdownPool(FakeConnection(), [asyncpg.CannotConnectNowError("")] * 10)
+    monkeypatch.setattr(main, "db_pool", pool)
+    monkeypatch.setattr(main, "running", True)
+    monkeypatch.setattr(main, "retry_delay", lambda attempt: 0)
+
+    first, second = run_writer([make_rows(1), make_rows(1)])
+
+    # Unwritten batches stay unresolved so their offsets are never committed
+    assert not first.done()
+    assert not second.done()
+
+
+class DroppingConnection(FakeConnection):
+    """Rejects batch writes and drops the connection once before row drop_at"""
+
+    def __init__(self, drop_at):
+        super().__init__(batch_error=TypeError("expected str, got int"))
+        self.drop_at = drop_at
+        self.dropped = False
+
+    async def execute(self, sql, *row):
+        if not self.dropped and len(self.inserted) == self.drop_at:
+            self.dropped = True
+            raise ConnectionResetError("connection reset")
+        await super().execute(sql, *row)
+
+
+def status_count(topic, status):
+    return main.MESSAGES_PROCESSED[(topic, status)]._value.get()
+
+
+def test_write_loop_retries_only_unsettled_rows_after_a_dropped_connection(
+    monkeypatch,
+):
+    conn = DroppingConnection(drop_at=2)
+    monkeypatch.setattr(main, "db_pool", FakePool(conn, []))
+    monkeypatch.setattr(main, "retry_delay", lambda attempt: 0)
+    rows = make_rows(4)
+    succeeded = status_count("resource.created", "success")
+    failed = status_count("resource.created", "failed")
+
+    (written,) = run_writer([rows])
+
+    assert written.done()
+    assert conn.inserted == rows
+    assert status_count("resource.created", "success") == succeeded + 4
+    assert status_count("resource.created", "failed") == failed
+
+
+def test_duplicate_id_counts_as_already_written():
+    class StoredConnection(FakeConnection):
+        async def execute(self, sql, *row):
+            raise asyncpg.UniqueViolationError("duplicate key value")
+
+    succeeded = status_count("resource.created", "success")
+    failed = status_count("resource.created", "failed")
+
+    asyncio.run(main.insert_rows_individually(StoredConnection(), make_rows(2)))
+
+    assert status_count("resource.created", "success") == succeeded + 2
+    assert status_count("resource.created", "failed") == failed
+
+
+def test_init_database_retries_while_the_server_starts(monkeypatch):
+    pool = object()
+    attempts = [asyncpg.CannotConnectNowError("the database system is starting up")]
+
+    async def create_pool(**kwargs):
+        if attempts:
+            raise attempts.pop()
+        return pool
+
+    monkeypatch.setattr(main.asyncpg, "create_pool", create_pool)
+    monkeypatch.setattr(main, "retry_delay", lambda attempt: 0)
+
+    assert asyncio.run(main.init_database()) is pool
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        asyncpg.InvalidPasswordError("password authentication failed"),
+        asyncpg.InvalidCatalogNameError('database "workerdb" does not exist'),
+    ],
+)
+def test_init_database_exits_on_configuration_errors(monkeypatch, error):
+    async def create_pool(**kwargs):
+        raise error
+
+    monkeypatch.setattr(main.asyncpg, "create_pool", create_pool)
+
+    with pytest.raises(SystemExit) as exc_info:
+        asyncio.run(main.init_database())
+    assert exc_info.value.code == 1
+
+
+def test_retry_delay_backs_off_exponentially_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(main, "DB_RETRY_DELAY_SECONDS", 1.0)
+    monkeypatch.setattr(main, "DB_RETRY_MAX_DELAY_SECONDS", 10.0)
+
+    assert [main.retry_delay(attempt) for attempt in range(6)] == [
+        1.0,
+        2.0,
+        4.0,
+        8.0,
+        10.0,
+        10.0,
+    ]
+
+
+def test_supervisor_removes_the_metrics_directory_it_created(monkeypatch, tmp_path):
+    created = []
+
+    def mkdtemp(prefix):
+        path = tmp_path / prefix
+        path.mkdir()
+        created.append(path)
+        return str(path)
+
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", "")
+    monkeypatch.setattr(main.tempfile, "mkdtemp", mkdtemp)
+    monkeypatch.setattr(main, "start_http_server", lambda port, registry: None)
+    monkeypatch.setattr(main.signal, "signal", lambda signum, handler: None)
+    monkeypatch.setattr(main, "WORKER_CONCURRENCY", 0)
+
+    main.run_supervisor()
+
+    assert len(created) == 1
+    assert not created[0].exists()
+
+
+def test_supervisor_keeps_a_configured_metrics_directory(monkeypatch, tmp_path):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "start_http_server", lambda port, registry: None)
+    monkeypatch.setattr(main.signal, "signal", lambda signum, handler: None)
+    monkeypatch.setattr(main, "WORKER_CONCURRENCY", 0)
+
+    main.run_supervisor()
+
+    assert tmp_path.exists()
+
+
+def test_task_completed_row_coerces_numeric_ids():
+    raw = orjson.dumps({"task_id": 42, "resource_id": 7, "action": "run"})
+    row = main.process_task_completed({}, raw, PROCESSED_AT)
+
+    assert row[2:5] == ("7", "42", "run")
+
+
+def test_resource_event_row_from_payload():
+    raw = orjson.dumps({"id": 12, "name": "widget"})
+    row = main.HANDLERS["resource.updated"]({}, raw, PROCESSED_AT)
+
+    assert isinstance(row[0], uuid.UUID)
+    assert row[1:] == ("resource.updated", "12", None, "updated", raw, PROCESSED_AT)
+
+
+def test_resource_event_missing_id_is_rejected():
+    raw = orjson.dumps({"name": "widget"})
+    assert main.HANDLERS["resource.created"]({}, raw, PROCESSED_AT) is None
+
+
+def test_build_row_with_progress_logging_disabled(monkeypatch):
+    monkeypatch.setattr(main, "LOG_SAMPLE_INTERVAL", 0)
+    raw = orjson.dumps({"id": "r-1"})
+
+    row = main.build_row("resource.created", None, raw, None, PROCESSED_AT)
+
+    assert row[1:3] == ("resource.created", "r-1")
+
+
+def test_task_completed_row_from_payload():
+    raw = orjson.dumps({"task_id": "t-1", "resource_id": "r-1", "action": "run"})
+    row = main.process_task_completed({}, raw, PROCESSED_AT)
+
+    assert isinstance(row[0], uuid.UUID)
+    assert row[1:] == ("task.completed", "r-1", "t-1", "run", raw, PROCESSED_AT)
+
+
+def test_task_completed_missing_field_is_rejected():
+    raw = orjson.dumps({"task_id": "t-1", "action": "run"})
+    assert main.process_task_completed({}, raw, PROCESSED_AT) is None
+
+
+def make_record(msg, exc_info=None, **attributes):
+    record = logging.LogRecord("main", logging.ERROR, __file__, 1, msg, None, exc_info)
+    record.__dict__.update(attributes)
+    return record
+
+
+def test_json_formatter_merges_extra_fields():
+    record = make_record(
+        "Batch written", extra_fields={"rows": 3, "ratio": Decimal("0.5")}
+    )
+
+    entry = orjson.loads(main.FastJsonFormatter().format(record))
+
+    assert entry["message"] == "Batch written"
+    assert entry["level"] == "ERROR"
+    assert entry["name"] == "main"
+    assert entry["rows"] == 3
+    # Values orjson cannot encode natively fall back to str()
+    assert entry["ratio"] == "0.5"
+    assert "exc_info" not in entry
+
+
+def test_json_formatter_includes_traceback():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = make_record("Failed", exc_info=sys.exc_info())
+
+    entry = orjson.loads(main.FastJsonFormatter().format(record))
+
+    assert "ValueError: boom" in entry["exc_info"]
+
+
+def test_task_completed_row_from_headers_skips_payload():
+    fields = {"task_id": "t-1", "resource_id": "r-1", "action": "run"}
+    # The payload would fail to decode if it were read
+    row = main.process_task_completed(fields, b"not json", PROCESSED_AT)
+
+    assert row[1:5] == ("task.completed", "r-1", "t-1", "run")
+
+
+def test_resource_event_row_from_header():
+    row = main.HANDLERS["resource.deleted"](
+        {"resource_id": "r-9"}, b"not json", PROCESSED_AT
+    )
+
+    assert row[1:5] == ("resource.deleted", "r-9", None, "deleted")
+
+
+def test_header_fields_keeps_known_non_empty_headers():
+    headers = [
+        ("task_id", b"t-1"),
+        ("resource_id", b""),
+        ("traceparent", b"00-abc"),
+        ("action", b"run"),
+    ]
+    assert main.header_fields(headers) == {"task_id": "t-1", "action": "run"}
+
+
+def test_header_fields_without_headers():
+    assert main.header_fields(None) == {}
+    assert main.header_fields([]) == {}